@@ -1,10 +1,14 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
 
 
 class SectoralDiffReport:
     
-    def __init__(self, misc_dir_path, iso_alpha_3, init_year, ref_year=2015, ref_primary_id=0):
+    def __init__(self, misc_dir_path, iso_alpha_3, init_year, ref_year=2015, ref_primary_id=0, output_format='csv'):
         """
         Initialize the utility class with the given parameters.
         Args:
@@ -13,6 +17,7 @@ class SectoralDiffReport:
             init_year (int): The initial year for the simulation.
             ref_year (int, optional): The reference year. Defaults to 2015.
             ref_primary_id (int, optional): The reference primary ID. Defaults to 0.
+            output_format (str, optional): The file format of the written reports, 'csv' or 'parquet'. Defaults to 'csv'.
         Attributes:
             iso_alpha_3 (str): The ISO 3166-1 alpha-3 country code.
             ref_year (int): The reference year.
@@ -22,6 +27,11 @@ class SectoralDiffReport:
             edga_file_path (str): The path to the EDGAR data file containing ground truth data.
             misc_dir_path (str): The directory path where miscellaneous files are stored.
             report_type (str): The type of report, default is 'all-sectors'.
+            output_format (str): The file format of the written reports, 'csv' or 'parquet'.
+            _mapping_df (pd.DataFrame): Cached mapping table with the parsed '_vars_list' column.
+            _mapping_mtime (float): Modification time of the mapping table when it was cached.
+            _edgar_df (pd.DataFrame): Cached long-format Edgar data.
+            _edgar_cache_key (tuple): Edgar file mtime, country code and reference year the cached data was built for.
         """
         
         # Set up variables
@@ -33,83 +43,110 @@ class SectoralDiffReport:
         self.edga_file_path = os.path.join(misc_dir_path, 'CSC-GHG_emissions-April2024_to_calibrate.csv') # Edgar data file path containing ground truth data
         self.misc_dir_path = misc_dir_path
         self.report_type = 'all-sectors'
+        self.output_format = output_format # Report file format
+        self._mapping_df = None # Cached mapping table
+        self._mapping_mtime = None # Mapping table mtime at caching time
+        self._edgar_df = None # Cached Edgar data
+        self._edgar_cache_key = None # (mtime, iso_alpha_3, ref_year) of the cached Edgar data
 
     def load_mapping_table(self):
+        # Reuse the cached mapping table unless the file changed on disk
+        mapping_mtime = os.path.getmtime(self.mapping_table_path)
+        if self._mapping_df is not None and self._mapping_mtime == mapping_mtime:
+            return self._mapping_df
+
         # Load mapping tables
-        mapping_df = pd.read_csv(self.mapping_table_path)
-        
+        mapping_df = pd.read_csv(self.mapping_table_path, engine='pyarrow')
+
+        # Parse the Vars column into lists of variable names once at load time
+        mapping_df['_vars_list'] = mapping_df['Vars'].str.split(':')
+
+        self._mapping_df = mapping_df
+        self._mapping_mtime = mapping_mtime
+
         return mapping_df
     
     def load_simulation_output_data(self, simulation_df):
 
-        simulation_df_filtered = simulation_df.copy()
-
-        # Add a year column to the simulation data
-        simulation_df_filtered['year'] = simulation_df_filtered['time_period'] + self.init_year
-
-        # Filter the simulation data to the reference year and reference primary id
-        simulation_df_filtered = simulation_df_filtered[(simulation_df_filtered['year'] == self.ref_year) & (simulation_df_filtered['primary_id'] == self.ref_primary_id)]
+        # Filter the simulation data to the reference year and reference primary id, building the
+        # mask in a preallocated buffer from zero-copy views of the filter columns
+        time_period = simulation_df['time_period'].to_numpy()
+        primary_id = simulation_df['primary_id'].to_numpy()
+        mask = np.empty(len(simulation_df), dtype=bool)
+        np.equal(time_period, self.ref_year - self.init_year, out=mask)
+        mask &= primary_id == self.ref_primary_id
+        simulation_df_filtered = simulation_df.loc[mask].copy()
+
+        # Add a year column to the filtered simulation data
+        simulation_df_filtered['year'] = self.ref_year
  
         return simulation_df_filtered
     
     def edgar_data_etl(self):
-        # Load Edgar data
-        edgar_df = pd.read_csv(self.edga_file_path, encoding='latin1')
-
-        # Filter Edgar data to the reference year and reference primary id
-        edgar_df = edgar_df[edgar_df['Code'] == self.iso_alpha_3].reset_index(drop=True)
-
-        # Create Edgar_Class column by combining Subsector and Gas columns
-        edgar_df['Edgar_Class'] = edgar_df['CSC Subsector'] + ':' + edgar_df['Gas']
-
-        # Specify the id_vars (columns to keep) and value_vars (columns to unpivot)
-        
-        id_vars = ['Edgar_Class']
-        value_vars = [str(self.ref_year)]
-
-        # Melt the DataFrame
-        edgar_df_long = edgar_df.melt(id_vars=id_vars, value_vars=value_vars, 
-                        var_name='Year', value_name='Edgar_Values')
+        # Reuse the cached Edgar data unless the file, country or reference year changed
+        edgar_cache_key = (os.path.getmtime(self.edga_file_path), self.iso_alpha_3, self.ref_year)
+        if self._edgar_df is not None and self._edgar_cache_key == edgar_cache_key:
+            return self._edgar_df
+
+        # Load Edgar data, parsing only the columns needed for the reference year
+        edgar_table = pa_csv.read_csv(
+            self.edga_file_path,
+            read_options=pa_csv.ReadOptions(encoding='latin1'),
+            convert_options=pa_csv.ConvertOptions(include_columns=['Code', 'CSC Subsector', 'Gas', str(self.ref_year)]),
+        )
+
+        # Filter Edgar data to the reference country before converting to pandas
+        edgar_df = edgar_table.filter(pc.equal(edgar_table['Code'], self.iso_alpha_3)).to_pandas()
+
+        # Create Edgar_Class by combining Subsector and Gas columns
+        edgar_class = edgar_df['CSC Subsector'].str.cat(edgar_df['Gas'], sep=':')
+
+        # Select the reference year values into long format (a single year column needs no melt)
+        edgar_df_long = pd.DataFrame({
+            'Edgar_Class': edgar_class.astype('category'),
+            'Year': self.ref_year,
+            'Edgar_Values': edgar_df[str(self.ref_year)],
+        })
+
+        self._edgar_df = edgar_df_long
+        self._edgar_cache_key = edgar_cache_key
 
-        # Convert the 'year' column to integer type
-        edgar_df_long['Year'] = edgar_df_long['Year'].astype(int)
-        
         return edgar_df_long
 
     
     def calculate_ssp_emission_totals(self, simulation_df, mapping_df):
         
-        # Create detailed report df from mapping df
-        detailed_report_draft_df = mapping_df.copy()
-        
-        # Add a new column to store total emissions
-        detailed_report_draft_df['Simulation_Values'] = 0  # Initialize with zeros
+        # Create detailed report df from a shallow copy of mapping df: the column buffers are shared, and columns
+        # are only ever replaced (never modified in place), so the cached mapping table is left untouched
+        detailed_report_draft_df = mapping_df.copy(deep=False)
 
-        # Create a set of all column names in simulation_df for quick lookup
-        simulation_df_cols = set(simulation_df.columns)
+        # Store the groupby keys as categoricals so they hash as integer codes
+        detailed_report_draft_df['Subsector'] = detailed_report_draft_df['Subsector'].astype('category')
+        detailed_report_draft_df['Edgar_Class'] = detailed_report_draft_df['Edgar_Class'].astype('category')
 
-        # Create a set to store all missing variable names
-        missing_variables = set()
+        # Index the column names of simulation_df for hash-based lookup
+        sim_cols_idx = pd.Index(simulation_df.columns)
 
-        # Iterate through each row in detailed_report_draft_df
-        for index, row in detailed_report_draft_df.iterrows():
-            vars_list = row['Vars'].split(':')  # Split Vars column into variable names
+        # Explode the parsed Vars lists so each mapping row yields one row per variable name,
+        # keeping the mapping row position of every variable as its index
+        exploded_vars_df = mapping_df[['_vars_list']].reset_index(drop=True).explode('_vars_list')
+        vars_array = exploded_vars_df['_vars_list'].to_numpy()
+        group_ids = exploded_vars_df.index.to_numpy()
 
-            # Check which variable names are missing in simulation_df
-            missing_in_row = [var for var in vars_list if var not in simulation_df_cols]
-            missing_variables.update(missing_in_row)  # Add missing variables to the set
+        # Locate each variable among the simulation_df columns (-1 if missing)
+        col_ids = sim_cols_idx.get_indexer(vars_array)
+        present_mask = col_ids >= 0
 
-            # Filter the columns in simulation_df that match the variable names
-            matching_columns = [col for col in vars_list if col in simulation_df_cols]
+        # Collect all missing variable names
+        missing_variables = pd.Index(exploded_vars_df['_vars_list'].unique()).difference(sim_cols_idx).tolist()
 
-            if matching_columns:
-                # Sum the matching columns across all rows in simulation_df
-                subsector_total_emissions = simulation_df[matching_columns].sum().sum()
-            else:
-                subsector_total_emissions = 0  # No matching columns found
+        # Sum each matching column across all rows in simulation_df
+        used_col_ids, vals_ids = np.unique(col_ids[present_mask], return_inverse=True)
+        vals = simulation_df.iloc[:, used_col_ids].sum(axis=0).to_numpy(dtype=float)
 
-            # Update the simulation_values column in detailed_report_draft_df
-            detailed_report_draft_df.at[index, 'Simulation_Values'] = subsector_total_emissions
+        # Accumulate the variable totals per mapping row (missing variables contribute 0)
+        detailed_report_draft_df['Simulation_Values'] = np.bincount(group_ids[present_mask], weights=vals[vals_ids],
+                                                                    minlength=len(mapping_df))
 
         # Print missing variable names, if any
         if missing_variables:
@@ -122,42 +159,77 @@ class SectoralDiffReport:
         # Returns the updated detailed_report_draft_df
         return detailed_report_draft_df
     
-    def generate_detailed_diff_report(self, detailed_report_draft_df, edgar_df):
-
-        detailed_diff_report = detailed_report_draft_df.copy()
-
-        # Group by Subsector and Edgar_Class and aggregate the Simulation_Values to match Edgar_Values format
-        detailed_diff_report_agg = detailed_diff_report.groupby(['Subsector', 'Edgar_Class'])['Simulation_Values'].sum().reset_index()
-
-        # Merge the aggregated DataFrame with the Edgar data
-        detailed_diff_report_merge = pd.merge(detailed_diff_report_agg, edgar_df, how='left', left_on='Edgar_Class', right_on='Edgar_Class')
+    @staticmethod
+    def _relative_diff(simulation_values, edgar_values):
+        # Relative difference of the simulation against Edgar, NaN where Edgar_Values is zero or missing
+        simulation_values = np.asarray(simulation_values, dtype=float)
+        edgar_values = np.asarray(edgar_values, dtype=float)
+        diff = np.subtract(simulation_values, edgar_values)
+        return np.divide(diff, edgar_values, out=np.full_like(diff, np.nan), where=edgar_values != 0)
 
-        # Calculate the difference between Simulation_Values and Edgar_Values
-        detailed_diff_report_merge['diff'] = (detailed_diff_report_merge['Simulation_Values'] - detailed_diff_report_merge['Edgar_Values']) / detailed_diff_report_merge['Edgar_Values']
-
-        # Reset Year column to ref year to avoid NaN values
-        detailed_diff_report_merge['Year'] = self.ref_year
+    def generate_detailed_diff_report(self, detailed_report_draft_df, edgar_df):
 
-        detailed_diff_report_complete = detailed_diff_report_merge[['Year', 'Subsector', 'Edgar_Class', 'Simulation_Values', 'Edgar_Values', 'diff']]
+        # Factorize the Subsector and Edgar_Class keys into sorted integer codes
+        subsector_codes, subsectors = pd.factorize(detailed_report_draft_df['Subsector'], sort=True)
+        edgar_class_codes, edgar_classes = pd.factorize(detailed_report_draft_df['Edgar_Class'], sort=True)
+
+        # Combine both codes into a single group key, skipping rows with a missing key
+        valid = (subsector_codes >= 0) & (edgar_class_codes >= 0)
+        group_key = subsector_codes[valid].astype(np.int64) * len(edgar_classes) + edgar_class_codes[valid]
+        simulation_values = detailed_report_draft_df['Simulation_Values'].to_numpy(dtype=float)[valid]
+
+        # Sort by group key and aggregate the Simulation_Values of each run of equal keys to match Edgar_Values format
+        order = np.argsort(group_key, kind='stable')
+        sorted_group_key = group_key[order]
+        boundaries = np.flatnonzero(np.diff(sorted_group_key, prepend=-1))
+        simulation_totals = np.add.reduceat(simulation_values[order], boundaries)
+
+        # Decode the group keys back into their Subsector and Edgar_Class
+        unique_group_key = sorted_group_key[boundaries]
+        subsector_values = subsectors.take(unique_group_key // len(edgar_classes))
+        edgar_class_values = edgar_classes.take(unique_group_key % len(edgar_classes))
+
+        # Look up the Edgar value of each Edgar_Class
+        edgar_lookup = edgar_df.set_index('Edgar_Class')['Edgar_Values']
+        edgar_values = edgar_lookup.reindex(edgar_class_values).to_numpy(dtype=float)
+
+        # Build the report in its final column order, calculating the difference between Simulation_Values and Edgar_Values
+        detailed_diff_report_complete = pd.DataFrame({
+            'Year': self.ref_year,
+            'Subsector': subsector_values,
+            'Edgar_Class': edgar_class_values,
+            'Simulation_Values': simulation_totals,
+            'Edgar_Values': edgar_values,
+            'diff': self._relative_diff(simulation_totals, edgar_values),
+        })
         
         return detailed_diff_report_complete
     
     def generate_subsector_diff_report(self, detailed_diff_report_complete):
         
         # Group by Subsector and calculate the sum of the Simulation_Values and Edgar_Values
-        subsector_diff_report = detailed_diff_report_complete.groupby('Subsector')[['Simulation_Values', 'Edgar_Values']].sum().reset_index()
-
-        # Calculate the difference between Simulation_Values and Edgar_Values
-        subsector_diff_report['diff'] = (subsector_diff_report['Simulation_Values'] - subsector_diff_report['Edgar_Values']) / subsector_diff_report['Edgar_Values']
+        subsector_diff_report_agg = detailed_diff_report_complete.groupby('Subsector', observed=True)[['Simulation_Values', 'Edgar_Values']].sum().reset_index()
 
-        # Reset Year column to ref year to avoid NaN values
-        subsector_diff_report['Year'] = self.ref_year
-
-        # Reorder columns
-        subsector_diff_report = subsector_diff_report[['Year', 'Subsector', 'Simulation_Values', 'Edgar_Values', 'diff']] 
+        # Build the report in its final column order, calculating the difference between Simulation_Values and Edgar_Values
+        subsector_diff_report = pd.DataFrame({
+            'Year': self.ref_year,
+            'Subsector': subsector_diff_report_agg['Subsector'],
+            'Simulation_Values': subsector_diff_report_agg['Simulation_Values'],
+            'Edgar_Values': subsector_diff_report_agg['Edgar_Values'],
+            'diff': self._relative_diff(subsector_diff_report_agg['Simulation_Values'], subsector_diff_report_agg['Edgar_Values']),
+        })
 
         return subsector_diff_report
     
+    def write_report(self, report_df, report_name):
+        # Write the report to misc_dir_path in the configured output format
+        if self.output_format == 'csv':
+            report_df.to_csv(os.path.join(self.misc_dir_path, f'{report_name}_{self.report_type}.csv'), index=False)
+        elif self.output_format == 'parquet':
+            report_df.to_parquet(os.path.join(self.misc_dir_path, f'{report_name}_{self.report_type}.parquet'), index=False, compression='zstd')
+        else:
+            raise ValueError(f"Unsupported output_format '{self.output_format}', expected 'csv' or 'parquet'.")
+
     def generate_diff_reports(self, simulation_df):
 
         mapping_df = self.load_mapping_table()
@@ -167,8 +239,12 @@ class SectoralDiffReport:
         detailed_diff_report_complete = self.generate_detailed_diff_report(detailed_report_draft_df, edgar_df)
         subsector_diff_report = self.generate_subsector_diff_report(detailed_diff_report_complete)
 
-        detailed_diff_report_complete.to_csv(os.path.join(self.misc_dir_path, f'detailed_diff_report_{self.report_type}.csv'), index=False)
-        subsector_diff_report.to_csv(os.path.join(self.misc_dir_path, f'subsector_diff_report_{self.report_type}.csv'), index=False)
+        # Write both reports concurrently, re-raising any write error
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            detailed_future = executor.submit(self.write_report, detailed_diff_report_complete, 'detailed_diff_report')
+            subsector_future = executor.submit(self.write_report, subsector_diff_report, 'subsector_diff_report')
+            detailed_future.result()
+            subsector_future.result()
 
         return detailed_diff_report_complete, subsector_diff_report
 